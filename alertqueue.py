@@ -0,0 +1,212 @@
+"""Module to hold the durable queue for triggered alerts.
+
+Alerts are persisted to a small SQLite database before any delivery is
+attempted so that an emergency call survives a crash or restart of the
+process. This database keeps SQLite's default full synchronous commits,
+while the packet archive relaxes them (see archive.Connect) so that bulk
+packets are not fsynced one by one.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class Error(Exception):
+    """Base error class to use for this module."""
+
+
+class InProgressError(Error):
+    """Error class to use when the delivery worker is already running."""
+
+
+class AlertQueue(object):
+    """Crash-safe alert queue with at-least-once delivery."""
+
+    def __init__(self, db_string, sender, retry_interval=30,
+                 max_retry_interval=3600):
+        """Initializer.
+
+        Args:
+            db_string: SQL database file to persist the alerts in.
+            sender: Callable taking (recipients, subject, contents) which
+                delivers one alert and raises on failure.
+            retry_interval: Seconds to wait before retrying failed deliveries.
+                The wait doubles with every failed attempt of an alert.
+            max_retry_interval: Upper bound in seconds for the retry wait.
+                Alerts are never given up on.
+        """
+        self._db_string = db_string
+        self._sender = sender
+        self._retry_interval = retry_interval
+        self._max_retry_interval = max_retry_interval
+
+        # k: alert id, v: time before which the alert is not retried
+        self._retry_at = {}
+
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(db_string, check_same_thread=False)
+        with self._db_lock, self._db:
+            cur = self._db.cursor()
+            cur.execute('CREATE TABLE IF NOT EXISTS alerts ('
+                        'Id INTEGER PRIMARY KEY, created REAL, '
+                        'recipients TEXT, subject TEXT, contents TEXT, '
+                        'attempts INTEGER DEFAULT 0, delivered REAL)')
+
+        self._worker_thread = None
+        self._abort_deliver = False
+        self._wakeup = threading.Event()
+        self._drain_lock = threading.Lock()
+        self._logger = logging.getLogger(
+            "%s.%s" % (__name__, self.__class__.__name__))
+
+    def Put(self, recipients, subject, contents):
+        """Persists an alert and wakes up the delivery worker.
+
+        The alert is committed to disk before this function returns.
+
+        Args:
+            recipients: List of email addresses to send the alert to.
+            subject: Subject line of the alert.
+            contents: List of strings forming the alert body.
+
+        Returns:
+            Integer id of the queued alert.
+        """
+        with self._db_lock, self._db:
+            cur = self._db.cursor()
+            cur.execute('INSERT INTO alerts(created, recipients, subject, '
+                        'contents) VALUES (?, ?, ?, ?);',
+                        [time.time(), json.dumps(recipients), subject,
+                         json.dumps(contents)])
+            alert_id = cur.lastrowid
+        self._wakeup.set()
+        return alert_id
+
+    def Pending(self):
+        """Returns all alerts that have not been delivered yet.
+
+        Returns:
+            List of (id, recipients, subject, contents) tuples, oldest first.
+        """
+        return [alert[:4] for alert in self._pending()]
+
+    def _pending(self):
+        """Like Pending() but with the number of attempts appended."""
+        with self._db_lock:
+            rows = self._db.execute(
+                'SELECT Id, recipients, subject, contents, attempts '
+                'FROM alerts WHERE delivered IS NULL ORDER BY Id').fetchall()
+        return [(row[0], json.loads(row[1]), row[2], json.loads(row[3]),
+                 row[4]) for row in rows]
+
+    def _mark(self, alert_id, delivered):
+        """Records the outcome of one delivery attempt.
+
+        Args:
+            alert_id: Id of the alert that was attempted.
+            delivered: Boolean flag whether the delivery succeeded.
+        """
+        with self._db_lock, self._db:
+            if delivered:
+                self._db.execute(
+                    'UPDATE alerts SET attempts = attempts + 1, delivered = ? '
+                    'WHERE Id = ?;', [time.time(), alert_id])
+            else:
+                self._db.execute(
+                    'UPDATE alerts SET attempts = attempts + 1 '
+                    'WHERE Id = ?;', [alert_id])
+
+    def Drain(self):
+        """Attempts delivery of all pending alerts once.
+
+        Only one drain runs at a time so that no alert is sent twice
+        concurrently; a call made while another drain is running returns
+        False right away. Alerts that failed before are skipped until their
+        backoff has passed.
+
+        Returns:
+            Boolean flag whether all pending alerts were delivered.
+        """
+        if not self._drain_lock.acquire(False):
+            return False
+        try:
+            ok = True
+            for (alert_id, recipients, subject, contents,
+                 attempts) in self._pending():
+                if self._abort_deliver:
+                    return False
+                if self._retry_at.get(alert_id, 0) > time.time():
+                    ok = False
+                    continue
+                try:
+                    self._sender(recipients, subject, contents)
+                except Exception as e:
+                    logging.warn('alert %d delivery failed: %s', alert_id, e)
+                    self._retry_at[alert_id] = time.time() + min(
+                        self._retry_interval * 2 ** attempts,
+                        self._max_retry_interval)
+                    self._mark(alert_id, False)
+                    ok = False
+                    continue
+                self._retry_at.pop(alert_id, None)
+                self._mark(alert_id, True)
+                logging.info('alert %d delivered', alert_id)
+            return ok
+        finally:
+            self._drain_lock.release()
+
+    def _deliver(self):
+        """Blocking function draining the queue until stopped.
+
+        Note: This function is meant to be started as a separate thread.
+            Pending alerts from a previous run are replayed right away.
+        """
+        while not self._abort_deliver:
+            self._wakeup.clear()
+            try:
+                ok = self.Drain()
+            except Exception as e:
+                # E.g. a locked database; keep the worker alive and retry.
+                logging.exception('alert queue drain failed: %s', e)
+                ok = False
+            if ok:
+                self._wakeup.wait()
+            else:
+                self._wakeup.wait(self._retry_interval)
+
+    def IsAlive(self):
+        """Returns whether or not the delivery worker is running."""
+        if not self._worker_thread:
+            return False
+        return self._worker_thread.isAlive()
+
+    def Start(self):
+        """Starts the delivery worker.
+
+        A worker still finishing up after Stop() is waited for first.
+
+        Raises:
+            InProgressError: Delivery worker already running.
+        """
+        if self.IsAlive():
+            if not self._abort_deliver:
+                raise InProgressError('delivery in progress already')
+            self._worker_thread.join()
+
+        self._abort_deliver = False
+        self._worker_thread = threading.Thread(
+            name='alerts', target=self._deliver)
+        self._worker_thread.daemon = True
+        self._worker_thread.start()
+
+    def Stop(self):
+        """Stops the delivery worker. Undelivered alerts stay queued."""
+        self._abort_deliver = True
+        self._wakeup.set()
+        if self._worker_thread:
+            self._worker_thread.join(5)
+            if not self._worker_thread.isAlive():
+                self._worker_thread = None
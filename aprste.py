@@ -12,6 +12,8 @@ import time
 import yagmail
 import readconfig
 
+import alertqueue
+import archive
 import modules
 
 from logging.config import dictConfig
@@ -29,7 +31,7 @@ class APRSnooper(object):
     """APRS receiver and processor."""
 
     def __init__(self, callsign, server, port, db_string='', aprs_filter='',
-                 reverse_geo=False):
+                 reverse_geo=False, alert_db_string='alerts.sqlite'):
         """Initializes aprsnooper
 
         Args:
@@ -40,6 +42,8 @@ class APRSnooper(object):
             aprs_filter: APRS filter string to apply.
             reverse_geo: Boolean flag defining whether to reverse lookup
                 coordinates for output. Note that his is costly.
+            alert_db_string: SQL database to persist triggered alerts in
+                until they have been delivered.
         """
         self._callsign = callsign
         self._server = server
@@ -52,12 +56,26 @@ class APRSnooper(object):
         self._db_string = db_string
         self._packet_count = 0
         self._consume_start = 0
+        self._alert_queue = alertqueue.AlertQueue(
+            alert_db_string, self._send_alert)
 
         self._module_factory = modules.ModuleFactory(
             reverse_geo=reverse_geo)
         self._logger = logging.getLogger(
             "%s.%s" % (__name__, self.__class__.__name__))
 
+    def _send_alert(self, recipients, subject, contents):
+        """Delivers one alert by email.
+
+        Args:
+            recipients: List of email addresses to send the alert to.
+            subject: Subject line of the alert.
+            contents: List of strings forming the alert body.
+        """
+        yagmail.SMTP(config_dict['mail']['username'],
+                     config_dict['mail']['app_password']).send(
+                         recipients, subject, contents)
+
     def _callback(self, packet):
         """Callback function for received packets.
 
@@ -67,16 +85,22 @@ class APRSnooper(object):
         if self._abort_consume:
             raise StopIteration()
 
+        packet['received'] = time.time()
         self._packet_count += 1
         if self._packet_count % 1000 == 0:
             logging.info('received %d packets in %d sec' % (
                 self._packet_count, int(time.time() - self._consume_start)))
 
         if self._db:
-            with self._db:
-                cur = self._db.cursor()
-                cur.execute('CREATE TABLE IF NOT EXISTS aprs (Id INTEGER PRIMARY KEY, raw TEXT)')
-                cur.execute("INSERT INTO aprs(raw) VALUES (?);", [packet['raw']])
+            try:
+                with self._db:
+                    cur = self._db.cursor()
+                    cur.execute(
+                        "INSERT INTO aprs(raw, received) VALUES (?, ?);",
+                        [packet['raw'], packet['received']])
+            except sqlite3.OperationalError as e:
+                # E.g. locked by an archive export; don't kill the consumer.
+                logging.warn('dropping packet, archive write failed: %s', e)
             return
 
         # Part of the function that looks for a string int the beacon and trigger an event
@@ -94,8 +118,7 @@ class APRSnooper(object):
                                 "\n\n APRS tracking: " + config_dict['aprs']['aprs_link'] + packet['from']]
 
                     subject = config_dict['mail']['subject_it']
-                    yagmail.SMTP(config_dict['mail']['username'], config_dict['mail']['app_password']).send(email_list,
-                                                                                       subject, contents)
+                    self._alert_queue.Put(email_list, subject, contents)
 
         module = self._module_factory.get(packet)
         if not module:
@@ -103,6 +126,10 @@ class APRSnooper(object):
             return
         module.handle(packet)
 
+    def Weather(self):
+        """Returns the rolling weather aggregates per station and region."""
+        return self._module_factory.by_format('wx').aggregator()
+
     def IsAlive(self):
         """Returns whether or not there is a live connection."""
         if not self._consumer_thread:
@@ -128,7 +155,7 @@ class APRSnooper(object):
         self._packet_count = 0
         self._consume_start = time.time()
         if self._db_string:
-            self._db = sqlite3.connect(self._db_string)
+            self._db = archive.Connect(self._db_string)
         ais.consumer(self._callback, raw=False, blocking=True, immortal=True)
 
         # The above is blocking. This will be called once we're done.
@@ -146,6 +173,10 @@ class APRSnooper(object):
         if self._consumer_thread:
             raise InProgressError('connection in progress already')
 
+        try:
+            self._alert_queue.Start()
+        except alertqueue.InProgressError:
+            pass  # Still delivering from a previous run.
         self._consumer_thread = threading.Thread(
             name='consumer', target=self._consume)
         self._consumer_thread.start()
@@ -155,6 +186,7 @@ class APRSnooper(object):
         self._abort_consume = True
         if self._consumer_thread:
             self._consumer_thread.join(5)
+        self._alert_queue.Stop()
 
 
 if __name__ == '__main__':
@@ -195,6 +227,10 @@ if __name__ == '__main__':
     p.add_argument('--db', '-d', default='',
                    metavar='<db>',
                    help='Database to connect to.')
+    p.add_argument('--alert_db', '-a', default='alerts.sqlite',
+                   metavar='<alert_db>',
+                   help='Database to queue triggered alerts in until they '
+                        'are delivered (default: alerts.sqlite).')
     p.add_argument('--reverse_geo', '-g', type=bool, default=False,
                    metavar='reverse_geo>',
                    help='Do reverse geo lookups (Default: False)')
@@ -211,7 +247,8 @@ if __name__ == '__main__':
     config_dict = readconfig.get_config_section()
 
     t = APRSnooper(args.callsign, args.server, port, args.db,
-                   aprs_filter=args.aprs_filter, reverse_geo=args.reverse_geo)
+                   aprs_filter=args.aprs_filter, reverse_geo=args.reverse_geo,
+                   alert_db_string=args.alert_db)
 
     t.Start()
 
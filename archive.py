@@ -0,0 +1,562 @@
+#!/usr/bin/env python
+
+"""Module to hold the packet archive and its columnar export.
+
+The live archive is the SQLite `aprs` table written by APRSnooper. Closed
+days can be rolled into compressed Parquet files partitioned by day and
+packet format, and streamed back for replay with callsign, time and
+bounding box filters applied to whole partitions and row groups before
+any data is read.
+
+Layout:
+    <out_dir>/day=YYYY-MM-DD/format=<format>/part-<first id>.parquet
+    <out_dir>/day=YYYY-MM-DD/_SUCCESS
+
+Packets archived before timestamps were recorded go to `day=unknown`.
+A day only counts as exported once its `_SUCCESS` marker exists.
+"""
+
+import aprslib
+import argparse
+import calendar
+import logging
+import os
+import shutil
+import sqlite3
+import time
+
+import modules
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+_DAY = 86400
+
+# Day partition for legacy packets without a received timestamp.
+_UNKNOWN_DAY = 'unknown'
+
+# Marker file written once all files of a day partition are complete.
+_SUCCESS = '_SUCCESS'
+
+# Columns stored for each packet in the Parquet files.
+_COLUMNS = ('received', 'from', 'to', 'format', 'latitude', 'longitude',
+            'raw')
+
+
+class Error(Exception):
+    """Base error class to use for this module."""
+
+
+class MissingDependencyError(Error):
+    """Error class to use when pyarrow is not installed."""
+
+
+def Connect(db_string):
+    """Connects to the packet archive and makes sure the schema is current.
+
+    Archives created before packets were timestamped get a `received`
+    column added; their existing rows keep a NULL timestamp.
+
+    The archive runs in WAL mode with normal synchronous commits: a crash
+    may lose the last few packets but each insert no longer waits for an
+    fsync. Alerts are kept durable separately by alertqueue.
+
+    Args:
+        db_string: SQL database to connect to.
+
+    Returns:
+        sqlite3 connection.
+    """
+    db = sqlite3.connect(db_string)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    with db:
+        cur = db.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS aprs ('
+                    'Id INTEGER PRIMARY KEY, raw TEXT, received REAL)')
+        columns = [row[1] for row in cur.execute('PRAGMA table_info(aprs)')]
+        if 'received' not in columns:
+            cur.execute('ALTER TABLE aprs ADD COLUMN received REAL')
+        cur.execute('CREATE INDEX IF NOT EXISTS aprs_received '
+                    'ON aprs(received)')
+    return db
+
+
+def _CheckDependency():
+    if pq is None:
+        raise MissingDependencyError(
+            'pyarrow is required for archive export and replay')
+
+
+def _Day(timestamp):
+    if timestamp is None:
+        return _UNKNOWN_DAY
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+
+def _Schema():
+    return pa.schema([('received', pa.float64()),
+                      ('from', pa.string()),
+                      ('to', pa.string()),
+                      ('format', pa.string()),
+                      ('latitude', pa.float64()),
+                      ('longitude', pa.float64()),
+                      ('raw', pa.string())])
+
+
+def _Row(raw, received):
+    """Extracts the filterable columns from one raw packet.
+
+    Args:
+        raw: Raw APRS packet string.
+        received: Time the packet was received in seconds since the epoch.
+
+    Returns:
+        Tuple of values in the order of _COLUMNS.
+    """
+    try:
+        packet = aprslib.parse(raw)
+    except (aprslib.ParseError, aprslib.UnknownFormat):
+        packet = {}
+    return (received,
+            packet.get('from'),
+            packet.get('to'),
+            packet.get('format', 'unknown'),
+            packet.get('latitude'),
+            packet.get('longitude'),
+            raw)
+
+
+def _CompletedDays(out_dir):
+    """Returns the days whose partitions have a _SUCCESS marker."""
+    days = set()
+    if not os.path.isdir(out_dir):
+        return days
+    for day_dir in os.listdir(out_dir):
+        if (day_dir.startswith('day=') and
+                os.path.exists(os.path.join(out_dir, day_dir, _SUCCESS))):
+            days.add(day_dir[len('day='):])
+    return days
+
+
+def _SortKey(row):
+    return (row[1] or '', row[0] or 0)
+
+
+class _PartitionWriter(object):
+    """Buffers rows of one partition and writes them as row groups.
+
+    Each buffer is sorted by callsign, then time, before it is split into
+    row groups, so that the min/max statistics of a row group only cover
+    a narrow range of callsigns (and thus of positions).
+    """
+
+    def __init__(self, path, row_group_size, sort_buffer_size):
+        self._path = path
+        self._tmp_path = path + '.tmp'
+        self._row_group_size = row_group_size
+        self._sort_buffer_size = sort_buffer_size
+        self._rows = []
+        self._writer = None
+
+    def append(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self._sort_buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        self._rows.sort(key=_SortKey)
+        if not self._writer:
+            directory = os.path.dirname(self._path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._writer = pq.ParquetWriter(
+                self._tmp_path, _Schema(), compression='zstd')
+        schema = _Schema()
+        arrays = [pa.array([row[i] for row in self._rows],
+                           type=schema.field(name).type)
+                  for i, name in enumerate(_COLUMNS)]
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=schema),
+                                 row_group_size=self._row_group_size)
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        if self._writer:
+            self._writer.close()
+            os.rename(self._tmp_path, self._path)
+
+
+def _CloseDay(out_dir, day, writers):
+    """Closes all writers of a day and marks the day as complete.
+
+    Args:
+        out_dir: Directory holding the partitioned Parquet files.
+        day: Day partition being closed.
+        writers: Dictionary of the day's _PartitionWriter by format.
+    """
+    for writer in writers.values():
+        writer.close()
+    with open(os.path.join(out_dir, 'day=%s' % day, _SUCCESS), 'w'):
+        pass
+
+
+def _Compact(db, ranges, batch_size):
+    """Deletes the packets exported by this run from SQLite.
+
+    Every packet with an Id inside a day's range that falls into that day
+    was read and written by this run, so only those are deleted. Deletes
+    run in small transactions to keep the live receiver writing.
+
+    Args:
+        db: sqlite3 connection to the packet archive.
+        ranges: Dictionary of [first Id, last Id] exported by day.
+        batch_size: Number of Ids covered by one delete transaction.
+    """
+    for day, (first_id, last_id) in ranges.items():
+        if day == _UNKNOWN_DAY:
+            condition, args = 'received IS NULL', []
+        else:
+            start = calendar.timegm(time.strptime(day, '%Y-%m-%d'))
+            condition = 'received >= ? AND received < ?'
+            args = [start, start + _DAY]
+        low = first_id
+        while low <= last_id:
+            high = min(low + batch_size, last_id + 1)
+            with db:
+                db.execute('DELETE FROM aprs WHERE Id >= ? AND Id < ? AND ' +
+                           condition, [low, high] + args)
+            low = high
+
+
+def Export(db_string, out_dir, before=None, compact=False, vacuum=False,
+           row_group_size=5000, sort_buffer_size=100000, batch_size=10000):
+    """Rolls closed days of the packet archive into Parquet files.
+
+    Only whole UTC days before `before` are exported, plus legacy packets
+    without a timestamp into `day=unknown`. Days already marked complete
+    in `out_dir` are skipped and leftovers of an interrupted run are
+    rewritten, so running the export repeatedly is safe. Packets are read
+    in short Id-ordered chunks, so the live receiver can keep writing and
+    nothing is loaded all at once.
+
+    Args:
+        db_string: SQL database holding the `aprs` table.
+        out_dir: Directory to write the partitioned Parquet files to.
+        before: Timestamp up to which days are closed (default: now).
+        compact: Boolean flag whether to delete the packets exported by
+            this run from SQLite. Packets of days completed by an earlier
+            run are never deleted.
+        vacuum: Boolean flag whether to VACUUM the database afterwards to
+            return the freed space. This locks out the live receiver.
+        row_group_size: Number of rows per Parquet row group.
+        sort_buffer_size: Number of rows sorted by callsign at a time.
+        batch_size: Number of rows read or deleted per transaction.
+
+    Returns:
+        Number of packets written.
+
+    Raises:
+        MissingDependencyError: pyarrow is not installed.
+    """
+    _CheckDependency()
+    if before is None:
+        before = time.time()
+    cutoff = int(before) // _DAY * _DAY
+
+    completed = _CompletedDays(out_dir)
+    # k: day, v: {format: _PartitionWriter}
+    writers = {}
+    # k: day, v: [first Id, last Id] exported by this run
+    ranges = {}
+    count = partitions = skipped = 0
+    current_day = None
+    last_id = 0
+    db = Connect(db_string)
+    try:
+        while True:
+            rows = db.execute('SELECT Id, raw, received FROM aprs '
+                              'WHERE Id > ? AND '
+                              '(received < ? OR received IS NULL) '
+                              'ORDER BY Id LIMIT ?',
+                              [last_id, cutoff, batch_size]).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            for row_id, raw, received in rows:
+                day = _Day(received)
+                if day in completed:
+                    skipped += 1
+                    continue
+                if day not in ranges:
+                    ranges[day] = [row_id, row_id]
+                    # Drop partial files of a previously interrupted run.
+                    day_dir = os.path.join(out_dir, 'day=%s' % day)
+                    if os.path.isdir(day_dir):
+                        shutil.rmtree(day_dir)
+                ranges[day][1] = row_id
+                if day != _UNKNOWN_DAY and day != current_day:
+                    # Packets arrive roughly in time order, so earlier days
+                    # are complete. A late packet reopens its day with a
+                    # new part file.
+                    for done in [d for d in writers
+                                 if d != _UNKNOWN_DAY and d < day]:
+                        _CloseDay(out_dir, done, writers.pop(done))
+                    current_day = day
+                row = _Row(raw, received)
+                day_writers = writers.setdefault(day, {})
+                writer = day_writers.get(row[3])
+                if not writer:
+                    path = os.path.join(out_dir, 'day=%s' % day,
+                                        'format=%s' % row[3],
+                                        'part-%d.parquet' % row_id)
+                    writer = _PartitionWriter(path, row_group_size,
+                                              sort_buffer_size)
+                    day_writers[row[3]] = writer
+                    partitions += 1
+                writer.append(row)
+                count += 1
+
+        for day in list(writers):
+            _CloseDay(out_dir, day, writers.pop(day))
+
+        if compact:
+            _Compact(db, ranges, batch_size)
+        if vacuum:
+            db.execute('VACUUM')
+    finally:
+        db.close()
+
+    if skipped:
+        logging.warn('left %d packets of already exported days in the '
+                     'database', skipped)
+    logging.info('exported %d packets into %d partitions', count, partitions)
+    return count
+
+
+def _Text(value):
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+def _RowGroupMatches(row_group, callsign, start, end, bbox):
+    """Checks whether a row group may hold matching rows using its statistics.
+
+    Args:
+        row_group: pyarrow RowGroupMetaData of the row group.
+        callsign, start, end, bbox: Filters as passed to Read().
+
+    Returns:
+        False if the statistics rule out any match, True otherwise.
+    """
+    stats = {}
+    for i in range(row_group.num_columns):
+        column = row_group.column(i)
+        if column.statistics is not None and column.statistics.has_min_max:
+            stats[column.path_in_schema] = (_Text(column.statistics.min),
+                                            _Text(column.statistics.max))
+
+    def Outside(name, low, high):
+        if name not in stats:
+            return False
+        col_min, col_max = stats[name]
+        return ((low is not None and col_max < low) or
+                (high is not None and col_min > high))
+
+    if callsign is not None and Outside('from', callsign, callsign):
+        return False
+    if Outside('received', start, end):
+        return False
+    if bbox is not None:
+        min_lat, min_lon, max_lat, max_lon = bbox
+        if (Outside('latitude', min_lat, max_lat) or
+                Outside('longitude', min_lon, max_lon)):
+            return False
+    return True
+
+
+def Read(in_dir, callsign=None, start=None, end=None, bbox=None,
+         formats=None):
+    """Streams archived packets matching all given filters.
+
+    Day and format partitions are pruned by directory name and row groups
+    by their min/max statistics; only one row group is held in memory at
+    a time. Days without a _SUCCESS marker are incomplete and skipped.
+    Packets come out day by day, grouped by callsign within a day; each
+    station's packets stay in time order.
+
+    Args:
+        in_dir: Directory holding the partitioned Parquet files.
+        callsign: Only return packets sent by this callsign.
+        start: Only return packets received at or after this timestamp.
+        end: Only return packets received before this timestamp.
+            Packets without a timestamp never match a time filter.
+        bbox: Tuple (min_lat, min_lon, max_lat, max_lon) packets must be in.
+        formats: List of packet formats to return.
+
+    Yields:
+        Dictionaries with the keys in _COLUMNS.
+
+    Raises:
+        MissingDependencyError: pyarrow is not installed.
+    """
+    _CheckDependency()
+    first_day = _Day(start) if start is not None else None
+    last_day = _Day(end) if end is not None else None
+
+    for day_dir in sorted(os.listdir(in_dir)):
+        if not day_dir.startswith('day='):
+            continue
+        day = day_dir[len('day='):]
+        if not os.path.exists(os.path.join(in_dir, day_dir, _SUCCESS)):
+            continue
+        if day == _UNKNOWN_DAY:
+            if start is not None or end is not None:
+                continue
+        elif ((first_day and day < first_day) or
+              (last_day and day > last_day)):
+            continue
+        for format_dir in sorted(os.listdir(os.path.join(in_dir, day_dir))):
+            if not format_dir.startswith('format='):
+                continue
+            if formats and format_dir[len('format='):] not in formats:
+                continue
+            directory = os.path.join(in_dir, day_dir, format_dir)
+            for name in sorted(os.listdir(directory)):
+                if not name.endswith('.parquet'):
+                    continue
+                pf = pq.ParquetFile(os.path.join(directory, name))
+                for i in range(pf.num_row_groups):
+                    if not _RowGroupMatches(pf.metadata.row_group(i),
+                                            callsign, start, end, bbox):
+                        continue
+                    table = pf.read_row_group(i, columns=list(_COLUMNS))
+                    columns = [table.column(c).to_pylist() for c in _COLUMNS]
+                    for values in zip(*columns):
+                        row = dict(zip(_COLUMNS, values))
+                        if _RowMatches(row, callsign, start, end, bbox):
+                            yield row
+
+
+def _RowMatches(row, callsign, start, end, bbox):
+    if callsign is not None and row['from'] != callsign:
+        return False
+    if (start is not None or end is not None) and row['received'] is None:
+        return False
+    if start is not None and row['received'] < start:
+        return False
+    if end is not None and row['received'] >= end:
+        return False
+    if bbox is not None:
+        lat, lon = row['latitude'], row['longitude']
+        if lat is None or lon is None:
+            return False
+        min_lat, min_lon, max_lat, max_lon = bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+    return True
+
+
+def Replay(in_dir, callback, **filters):
+    """Feeds archived packets to a callback as if they were just received.
+
+    Each packet carries its original receive time in `received` (None for
+    legacy packets).
+
+    Args:
+        in_dir: Directory holding the partitioned Parquet files.
+        callback: Function taking one parsed packet dictionary.
+        filters: Keyword filters as accepted by Read().
+
+    Returns:
+        Number of packets replayed.
+    """
+    count = 0
+    for row in Read(in_dir, **filters):
+        try:
+            packet = aprslib.parse(row['raw'])
+        except (aprslib.ParseError, aprslib.UnknownFormat) as e:
+            logging.debug('skipping unparsable packet: %s', e)
+            continue
+        packet['received'] = row['received']
+        callback(packet)
+        count += 1
+    return count
+
+
+def _ParseTime(value):
+    """Parses a YYYY-MM-DD[THH:MM:SS] UTC string into a timestamp."""
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('invalid time: %s' % value)
+
+
+def _ParseBbox(value):
+    """Parses a min_lat,min_lon,max_lat,max_lon string."""
+    try:
+        bbox = tuple(float(v) for v in value.split(','))
+    except ValueError:
+        bbox = ()
+    if len(bbox) != 4:
+        raise argparse.ArgumentTypeError('invalid bbox: %s' % value)
+    return bbox
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    p = argparse.ArgumentParser(description='APRS Archive Export and Replay')
+    sub = p.add_subparsers(dest='command')
+
+    e = sub.add_parser('export', help='Roll closed days into Parquet files.')
+    e.add_argument('--db', '-d', required=True, metavar='<db>',
+                   help='Database to export from.')
+    e.add_argument('--out', '-o', required=True, metavar='<out>',
+                   help='Directory to write the Parquet files to.')
+    e.add_argument('--compact', action='store_true',
+                   help='Delete exported packets from the database.')
+    e.add_argument('--vacuum', action='store_true',
+                   help='Return freed space to the filesystem afterwards '
+                        '(blocks the live receiver while running).')
+
+    r = sub.add_parser('replay', help='Replay packets from Parquet files.')
+    r.add_argument('--in', '-i', dest='in_dir', required=True,
+                   metavar='<in>',
+                   help='Directory holding the Parquet files.')
+    r.add_argument('--callsign', '-c', metavar='<callsign>',
+                   help='Only replay packets from this callsign.')
+    r.add_argument('--start', type=_ParseTime, metavar='<start>',
+                   help='Only replay packets from this UTC time on.')
+    r.add_argument('--end', type=_ParseTime, metavar='<end>',
+                   help='Only replay packets before this UTC time.')
+    r.add_argument('--bbox', type=_ParseBbox,
+                   metavar='<min_lat,min_lon,max_lat,max_lon>',
+                   help='Only replay packets inside this bounding box.')
+    r.add_argument('--reverse_geo', '-g', type=bool, default=False,
+                   metavar='reverse_geo>',
+                   help='Do reverse geo lookups (Default: False)')
+    args = p.parse_args()
+
+    if args.command == 'export':
+        Export(args.db, args.out, compact=args.compact, vacuum=args.vacuum)
+    else:
+        factory = modules.ModuleFactory(reverse_geo=args.reverse_geo)
+
+        def handle(packet):
+            module = factory.get(packet)
+            if module:
+                module.handle(packet)
+
+        Replay(args.in_dir, handle, callsign=args.callsign, start=args.start,
+               end=args.end, bbox=args.bbox)
@@ -22,6 +22,7 @@ import threading
 import time
 
 import location
+import weather as weather_agg
 
 
 class Module(object):
@@ -133,6 +134,27 @@ class ObjectModule(GenericModule):
 class WeatherModule(Module):
     """Module handling weather reports."""
 
+    def __init__(self, reverse_geo=False):
+        super(WeatherModule, self).__init__(reverse_geo=reverse_geo)
+        self._aggregator = weather_agg.WeatherAggregator()
+        self._cache_clean_time = 600
+        self._cache_timer = None
+        self._cache_clean()
+
+    def _cache_clean(self):
+        if self._cache_timer:
+            self._cache_timer.cancel()
+        self._cache_timer = threading.Timer(
+            self._cache_clean_time, self._cache_clean)
+        self._cache_timer.daemon = True
+        self._cache_timer.start()
+
+        self._aggregator.expire()
+
+    def aggregator(self):
+        """Rolling aggregates of all weather reports handled so far."""
+        return self._aggregator
+
     def name(self):
         return 'Weather Reports'
 
@@ -143,6 +165,7 @@ class WeatherModule(Module):
         weather = packet.get('weather', None)
         if not weather:
             return
+        self._aggregator.add(packet)
 
         loc = self._locator.Lookup(packet)
         if loc:
@@ -156,8 +179,6 @@ class WeatherModule(Module):
         humidity = weather.get('humidity', 'n/a')
         pressure = weather.get('pressure', 'n/a')
         wind = weather.get('wind', 'n/a')
-        print 'weather(%s): temp(%s), humidity(%s)' % (
-            location, temperature, humidity)
 
         parts = ['weather(%s):' % location,
                  'temp(%s),' % temperature,
@@ -315,6 +336,17 @@ class ModuleFactory(object):
             instance = m(reverse_geo=reverse_geo)
             self._instances[instance.format()] = instance
 
+    def by_format(self, form):
+        """Retrieves the module registered for the given format.
+
+        Args:
+            form: Format string as returned by Module.format().
+
+        Returns:
+            Module instance or None if no module handles the format.
+        """
+        return self._instances.get(form)
+
     def get(self, packet):
         """Retrievees the right module for the packet.
 
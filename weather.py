@@ -0,0 +1,275 @@
+"""Module to hold rolling weather aggregates per station and region.
+
+Each window is split into a fixed number of time buckets that are reused
+in a ring. Reports are folded into the current bucket as they arrive and
+queries only merge the buckets of one window, so both cost the same no
+matter how many reports were received.
+"""
+
+import math
+import threading
+import time
+
+
+# Supported windows in seconds: 10 min, 1 h and 24 h.
+WINDOWS = (600, 3600, 86400)
+
+# Number of buckets each window is split into.
+_BUCKETS = 60
+
+
+class _Bucket(object):
+    """Accumulator for all reports falling into one time slice."""
+
+    __slots__ = ('index', 'count', 'temp_count', 'temp_sum', 'temp_min',
+                 'temp_max', 'pressure_first', 'pressure_last', 'gust_max')
+
+    def __init__(self, index):
+        self.index = index
+        self.count = 0
+        self.temp_count = 0
+        self.temp_sum = 0.0
+        self.temp_min = None
+        self.temp_max = None
+        self.pressure_first = None
+        self.pressure_last = None
+        self.gust_max = None
+
+    def add(self, temperature, pressure, gust):
+        self.count += 1
+        if temperature is not None:
+            self.temp_count += 1
+            self.temp_sum += temperature
+            if self.temp_min is None or temperature < self.temp_min:
+                self.temp_min = temperature
+            if self.temp_max is None or temperature > self.temp_max:
+                self.temp_max = temperature
+        if pressure is not None:
+            if self.pressure_first is None:
+                self.pressure_first = pressure
+            self.pressure_last = pressure
+        if gust is not None and (self.gust_max is None or gust > self.gust_max):
+            self.gust_max = gust
+
+
+class RollingWindow(object):
+    """Streaming aggregate over a fixed trailing time window."""
+
+    def __init__(self, window, buckets=_BUCKETS):
+        """Initializer.
+
+        Args:
+            window: Length of the window in seconds.
+            buckets: Number of buckets the window is split into.
+        """
+        self._window = window
+        self._width = float(window) / buckets
+        self._buckets = [None] * buckets
+
+    def add(self, timestamp, temperature=None, pressure=None, gust=None):
+        """Folds one weather report into the window.
+
+        Args:
+            timestamp: Time of the report in seconds since the epoch.
+            temperature: Temperature in degrees Celsius or None.
+            pressure: Pressure in hPa or None.
+            gust: Wind gust speed or None.
+        """
+        index = int(timestamp // self._width)
+        slot = index % len(self._buckets)
+        bucket = self._buckets[slot]
+        if bucket is None or bucket.index != index:
+            if bucket is not None and bucket.index > index:
+                return  # Too old to fit into the window any more.
+            bucket = _Bucket(index)
+            self._buckets[slot] = bucket
+        bucket.add(temperature, pressure, gust)
+
+    def summary(self, now=None):
+        """Merges all buckets still inside the window.
+
+        Args:
+            now: Reference time in seconds since the epoch (default: now).
+
+        Returns:
+            Dictionary with count, temp_min, temp_max, temp_mean,
+            pressure_trend and gust_max. Values are None if unknown.
+        """
+        if now is None:
+            now = time.time()
+        newest = int(now // self._width)
+        oldest = newest - len(self._buckets)
+
+        count = temp_count = 0
+        temp_sum = 0.0
+        temp_min = temp_max = gust_max = None
+        pressure_first = pressure_last = None
+        for bucket in sorted((b for b in self._buckets
+                              if b is not None and oldest < b.index <= newest),
+                             key=lambda b: b.index):
+            count += bucket.count
+            temp_count += bucket.temp_count
+            temp_sum += bucket.temp_sum
+            if bucket.temp_min is not None and (
+                    temp_min is None or bucket.temp_min < temp_min):
+                temp_min = bucket.temp_min
+            if bucket.temp_max is not None and (
+                    temp_max is None or bucket.temp_max > temp_max):
+                temp_max = bucket.temp_max
+            if bucket.gust_max is not None and (
+                    gust_max is None or bucket.gust_max > gust_max):
+                gust_max = bucket.gust_max
+            if bucket.pressure_first is not None:
+                if pressure_first is None:
+                    pressure_first = bucket.pressure_first
+                pressure_last = bucket.pressure_last
+
+        pressure_trend = None
+        if pressure_first is not None:
+            pressure_trend = pressure_last - pressure_first
+        return {'window': self._window,
+                'count': count,
+                'temp_min': temp_min,
+                'temp_max': temp_max,
+                'temp_mean': temp_sum / temp_count if temp_count else None,
+                'pressure_trend': pressure_trend,
+                'gust_max': gust_max}
+
+
+class WeatherAggregator(object):
+    """Rolling weather aggregates per station and per region."""
+
+    def __init__(self, windows=WINDOWS, region_size=1.0):
+        """Initializer.
+
+        Args:
+            windows: Tuple of window lengths in seconds to keep.
+            region_size: Size of a region grid cell in degrees.
+        """
+        self._windows = windows
+        self._region_size = region_size
+
+        # k: station callsign or region key
+        # v: [time of newest report, {window: RollingWindow}]
+        self._stations = {}
+        self._regions = {}
+        self._newest = 0
+        self._lock = threading.RLock()
+
+    def region(self, lat, lon):
+        """Returns the key of the region grid cell holding the coordinates.
+
+        Args:
+            lat: Latitude as a float.
+            lon: Longitude as a float.
+        """
+        size = self._region_size
+        return '%g,%g' % (math.floor(lat / size) * size,
+                          math.floor(lon / size) * size)
+
+    def _windows_for(self, store, key, timestamp):
+        entry = store.get(key)
+        if entry is None:
+            entry = [timestamp,
+                     dict((w, RollingWindow(w)) for w in self._windows)]
+            store[key] = entry
+        entry[0] = max(entry[0], timestamp)
+        return entry[1]
+
+    def expire(self):
+        """Drops stations and regions silent for longer than every window.
+
+        Age is measured against the newest report seen, so replayed
+        archives expire the same way as the live feed.
+        """
+        oldest = self._newest - max(self._windows)
+        with self._lock:
+            for store in (self._stations, self._regions):
+                for key in [k for k, v in store.items() if v[0] < oldest]:
+                    del store[key]
+
+    def add(self, packet, timestamp=None):
+        """Folds one weather packet into the station and region aggregates.
+
+        Args:
+            packet: Dictionary holding a parsed APRS weather packet.
+            timestamp: Time of the report (default: the packet's `received`
+                field, else now). The sender's own `timestamp` is not used
+                as station clocks are often off.
+        """
+        weather = packet.get('weather')
+        if not weather:
+            return
+        if timestamp is None:
+            timestamp = packet.get('received') or time.time()
+
+        temperature = weather.get('temperature')
+        pressure = weather.get('pressure')
+        gust = weather.get('wind_gust')
+
+        keys = [(self._stations, packet.get('from', 'n/a'))]
+        lat = packet.get('latitude')
+        lon = packet.get('longitude')
+        if lat is not None and lon is not None:
+            keys.append((self._regions, self.region(lat, lon)))
+
+        with self._lock:
+            self._newest = max(self._newest, min(timestamp, time.time()))
+            for store, key in keys:
+                for window in self._windows_for(store, key,
+                                                timestamp).values():
+                    window.add(timestamp, temperature, pressure, gust)
+
+    def _query(self, store, key, window, now):
+        if window not in self._windows:
+            raise ValueError('unsupported window: %s' % window)
+        with self._lock:
+            entry = store.get(key)
+            if entry is None:
+                return None
+            return entry[1][window].summary(now)
+
+    def station(self, callsign, window=3600, now=None):
+        """Returns the aggregate of one station.
+
+        Args:
+            callsign: Callsign of the weather station.
+            window: Window length in seconds, one of the configured windows.
+            now: Reference time in seconds since the epoch (default: now).
+
+        Returns:
+            Summary dictionary (see RollingWindow.summary) or None if the
+            station is unknown.
+
+        Raises:
+            ValueError: Window is not one of the configured windows.
+        """
+        return self._query(self._stations, callsign, window, now)
+
+    def region_summary(self, lat, lon, window=3600, now=None):
+        """Returns the aggregate of the region holding the coordinates.
+
+        Args:
+            lat: Latitude as a float.
+            lon: Longitude as a float.
+            window: Window length in seconds, one of the configured windows.
+            now: Reference time in seconds since the epoch (default: now).
+
+        Returns:
+            Summary dictionary (see RollingWindow.summary) or None if no
+            report was received for the region.
+
+        Raises:
+            ValueError: Window is not one of the configured windows.
+        """
+        return self._query(self._regions, self.region(lat, lon), window, now)
+
+    def stations(self):
+        """Returns the callsigns of all known stations."""
+        with self._lock:
+            return list(self._stations.keys())
+
+    def regions(self):
+        """Returns the keys of all known regions."""
+        with self._lock:
+            return list(self._regions.keys())